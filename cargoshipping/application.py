@@ -1,53 +1,100 @@
+from collections import OrderedDict
+from contextlib import contextmanager
 from datetime import datetime
-from typing import List, Optional
+from typing import (
+    Any,
+    Callable,
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    Optional,
+    Sequence,
+    Tuple,
+)
 from uuid import UUID
 
-from eventsourcing.application.process import ProcessApplication
-from eventsourcing.domain.model.aggregate import TAggregate, TAggregateEvent
+from eventsourcing.application.process import (
+    ProcessApplication,
+    ProcessApplicationWithSnapshotting,
+    WrappedRepository,
+)
 
 from cargoshipping.domainmodel import (
     Cargo,
+    CargoDetails,
     HandlingActivity,
-    Itinerary,
     Location,
-    REGISTERED_ROUTES,
+    NextExpectedActivity,
+    REGISTERED_ROUTES_BY_LOCATION,
+    Route,
 )
+from cargoshipping.records import CargoDetailsRecord
 
 # Cargo aggregates exist within an application, which
-# provides "application service" methods for clients.
-class BookingApplication(ProcessApplication[TAggregate, TAggregateEvent]):
+# provides "application service" methods for clients. Snapshots of
+# the Cargo aggregates are taken periodically, so that getting a cargo
+# only replays the events recorded since the last snapshot.
+class BookingApplication(ProcessApplicationWithSnapshotting):
     persist_event_type = Cargo.Event
+    snapshot_period = 10
+
+    # Maximum number of cargos kept in memory.
+    cargo_cache_size = 10000
+
+    def __init__(self, **kwargs: Any) -> None:
+        # Recently used cargos, least recently used first. Cached cargos
+        # are kept up-to-date because they are mutated by their own events.
+        self._cargo_cache: "OrderedDict[UUID, Cargo]" = OrderedDict()
+        # Cargos changed in the current batch, if a batch has been started.
+        self._batched_cargos: Optional[Dict[UUID, Cargo]] = None
+        self._is_batch_failed = False
+        # Command methods, indexed by name, for executing commands in bulk.
+        self._command_handlers: Dict[str, Callable[..., Any]] = {
+            "book_new_cargo": self.book_new_cargo,
+            "change_destination": self.change_destination,
+            "assign_route": self.assign_route,
+            "register_handling_event": self.register_handling_event,
+            "register_handling_events_bulk": self.register_handling_events_bulk,
+        }
+        super().__init__(**kwargs)
 
-    @staticmethod
     def book_new_cargo(
-        origin: Location, destination: Location, arrival_deadline: datetime
+        self, origin: Location, destination: Location, arrival_deadline: datetime
     ) -> UUID:
         cargo = Cargo.new_booking(origin, destination, arrival_deadline)
-        cargo.__save__()
+        self._save_cargo(cargo)
         return cargo.id
 
     def change_destination(self, tracking_id: UUID, destination: Location) -> None:
         cargo = self.get_cargo(tracking_id)
-        cargo.change_destination(destination)
-        cargo.__save__()
+        with self._evicting_cargo_on_error(tracking_id):
+            cargo.change_destination(destination)
+            self._save_cargo(cargo)
 
-    def request_possible_routes_for_cargo(self, tracking_id: UUID) -> List[Itinerary]:
+    def request_possible_routes_for_cargo(
+        self, tracking_id: UUID
+    ) -> Sequence[Route]:
         cargo = self.get_cargo(tracking_id)
-        from_location = (cargo.last_known_location or cargo.origin).value
-        to_location = cargo.destination.value
-        try:
-            possible_routes = REGISTERED_ROUTES[(from_location, to_location)]
-        except KeyError:
+        from_location = cargo.last_known_location or cargo.origin
+        to_location = cargo.destination
+        possible_routes = REGISTERED_ROUTES_BY_LOCATION.get(from_location, {}).get(
+            to_location
+        )
+        if possible_routes is None:
             raise Exception(
-                "Can't find routes from {} to {}".format(from_location, to_location)
+                "Can't find routes from {} to {}".format(
+                    from_location.value, to_location.value
+                )
             )
 
         return possible_routes
 
-    def assign_route(self, tracking_id: UUID, itinerary: Itinerary) -> None:
+    def assign_route(self, tracking_id: UUID, route: Route) -> None:
         cargo = self.get_cargo(tracking_id)
-        cargo.assign_route(itinerary)
-        cargo.__save__()
+        with self._evicting_cargo_on_error(tracking_id):
+            cargo.assign_route(route)
+            self._save_cargo(cargo)
 
     def register_handling_event(
         self,
@@ -57,14 +104,235 @@ class BookingApplication(ProcessApplication[TAggregate, TAggregateEvent]):
         handing_activity: HandlingActivity,
     ) -> None:
         cargo = self.get_cargo(tracking_id)
-        cargo.register_handling_event(
-            tracking_id, voyage_number, location, handing_activity
-        )
-        cargo.__save__()
+        with self._evicting_cargo_on_error(tracking_id):
+            cargo.register_handling_event(
+                tracking_id, voyage_number, location, handing_activity
+            )
+            self._save_cargo(cargo)
+
+    def register_handling_events_bulk(
+        self,
+        tracking_id: UUID,
+        handling_events: Sequence[Tuple[Optional[str], Location, HandlingActivity]],
+    ) -> None:
+        cargo = self.get_cargo(tracking_id)
+        with self._evicting_cargo_on_error(tracking_id):
+            for voyage_number, location, handling_activity in handling_events:
+                cargo.register_handling_event(
+                    tracking_id, voyage_number, location, handling_activity
+                )
+            self._save_cargo(cargo)
+
+    def execute_commands(
+        self, commands: Iterable[Tuple[str, Dict[str, Any]]]
+    ) -> List[Any]:
+        results = []
+        for command_name, kwargs in commands:
+            try:
+                handler = self._command_handlers[command_name]
+            except KeyError:
+                raise Exception("Unsupported command: {}".format(command_name))
+            results.append(handler(**kwargs))
+        return results
+
+    @contextmanager
+    def batch(self) -> Iterator[None]:
+        # Cargos changed by commands in the batch are saved together,
+        # in one database transaction, when the batch ends. If a command
+        # fails on a cargo that was changed earlier in the batch, nothing
+        # is saved and an exception is raised when the batch ends. Other
+        # failed commands, such as those for cargos that can't be found,
+        # don't change anything in the batch, so the batch is still saved.
+        if self._batched_cargos is not None:
+            raise Exception("Batch already started")
+        self._batched_cargos = {}
+        try:
+            yield
+            if self._is_batch_failed:
+                raise Exception("Batch not saved, because a command failed")
+            cargos = list(self._batched_cargos.values())
+            new_events = [e for cargo in cargos for e in cargo.__pending_events__]
+            self.save(cargos)
+        except Exception:
+            for tracking_id in self._batched_cargos:
+                self._cargo_cache.pop(tracking_id, None)
+            raise
+        finally:
+            self._batched_cargos = None
+            self._is_batch_failed = False
+        self.take_snapshots(new_events)
 
     def get_cargo(self, tracking_id: UUID) -> Cargo:
-        cargo = self.repository.get_instance_of(Cargo, tracking_id)
+        cargo = self._cargo_cache.get(tracking_id)
+        if cargo is None and self._batched_cargos is not None:
+            cargo = self._batched_cargos.get(tracking_id)
         if cargo is None:
+            cargo = self.repository.get_instance_of(Cargo, tracking_id)
+            if cargo is None:
+                raise Exception("Cargo not found: {}".format(tracking_id))
+        self._cache_cargo(cargo)
+        return cargo
+
+    def _save_cargo(self, cargo: Cargo) -> None:
+        if self._batched_cargos is None:
+            cargo.__save__()
+        else:
+            self._batched_cargos[cargo.id] = cargo
+        # Write through to the cache, so the saved cargo is got next time.
+        self._cache_cargo(cargo)
+
+    def _cache_cargo(self, cargo: Cargo) -> None:
+        self._cargo_cache[cargo.id] = cargo
+        self._cargo_cache.move_to_end(cargo.id)
+        if len(self._cargo_cache) > self.cargo_cache_size:
+            self._cargo_cache.popitem(last=False)
+
+    @contextmanager
+    def _evicting_cargo_on_error(self, tracking_id: UUID) -> Iterator[None]:
+        # If a command fails, the cached cargo may have been mutated by
+        # events that were not recorded, so it is evicted from the cache.
+        # If the cargo was changed earlier in the batch, it is removed from
+        # the batch, so it isn't got again, and the batch is failed, since
+        # those changes can't be saved without the failed command's changes.
+        try:
+            yield
+        except Exception:
+            self._cargo_cache.pop(tracking_id, None)
+            if self._batched_cargos is not None:
+                if self._batched_cargos.pop(tracking_id, None) is not None:
+                    self._is_batch_failed = True
+            raise
+
+
+# The current details of each cargo are projected into a table by a
+# process application that follows the booking application, so that
+# cargo details can be presented without replaying the cargo events.
+class CargoProjection(ProcessApplication):
+    def policy(self, repository: WrappedRepository, event: Cargo.Event) -> None:
+        if isinstance(event, Cargo.Created):
+            cargo = event.__mutate__(None)
+            record = CargoDetailsRecord(id=cargo.id)
+        elif isinstance(event, Cargo.Event):
+            record = self.get_cargo_details_record(event.originator_id)
+            cargo = self.cargo_from_record(record)
+            event.mutate(cargo)
+        else:
+            return
+        self.update_record_from_cargo(record, cargo)
+        repository.save_orm_obj(record)
+
+    def get_cargo_details(self, tracking_id: UUID) -> CargoDetails:
+        record = self.get_cargo_details_record(tracking_id)
+
+        # Present 'next_expected_activity'.
+        next_expected_activity: Optional[Tuple[str, ...]]
+        if record.next_expected_handling_activity is None:
+            next_expected_activity = None
+        elif record.next_expected_voyage_number is None:
+            next_expected_activity = (
+                record.next_expected_handling_activity,
+                record.next_expected_location,
+            )
+        else:
+            next_expected_activity = (
+                record.next_expected_handling_activity,
+                record.next_expected_location,
+                record.next_expected_voyage_number,
+            )
+
+        # Present the cargo details.
+        return {
+            "id": str(record.id),
+            "origin": record.origin,
+            "destination": record.destination,
+            "arrival_deadline": record.arrival_deadline,
+            "transport_status": record.transport_status,
+            "routing_status": record.routing_status,
+            "is_misdirected": record.is_misdirected,
+            "estimated_time_of_arrival": record.estimated_time_of_arrival,
+            "next_expected_activity": next_expected_activity,
+            "last_known_location": record.last_known_location,
+            "current_voyage_number": record.current_voyage_number,
+        }
+
+    def get_cargo_details_record(self, tracking_id: UUID) -> CargoDetailsRecord:
+        record = self.datastore.session.query(CargoDetailsRecord).get(tracking_id)
+        if record is None:
             raise Exception("Cargo not found: {}".format(tracking_id))
         else:
-            return cargo
+            return record
+
+    @staticmethod
+    def cargo_from_record(record: CargoDetailsRecord) -> Cargo:
+        # Cargo state is restored from the record, so that the cargo
+        # events can be applied by the domain model's mutator methods.
+        next_expected_activity: NextExpectedActivity
+        if record.next_expected_handling_activity is None:
+            next_expected_activity = None
+        elif record.next_expected_voyage_number is None:
+            next_expected_activity = (
+                HandlingActivity[record.next_expected_handling_activity],
+                Location[record.next_expected_location],
+            )
+        else:
+            next_expected_activity = (
+                HandlingActivity[record.next_expected_handling_activity],
+                Location[record.next_expected_location],
+                record.next_expected_voyage_number,
+            )
+        return Cargo.restore(
+            id=record.id,
+            origin=Location[record.origin],
+            destination=Location[record.destination],
+            arrival_deadline=record.arrival_deadline,
+            transport_status=record.transport_status,
+            routing_status=record.routing_status,
+            is_misdirected=record.is_misdirected,
+            estimated_time_of_arrival=record.estimated_time_of_arrival,
+            next_expected_activity=next_expected_activity,
+            route_id=record.route_id,
+            last_known_location=(
+                None
+                if record.last_known_location is None
+                else Location[record.last_known_location]
+            ),
+            current_voyage_number=record.current_voyage_number,
+        )
+
+    @staticmethod
+    def update_record_from_cargo(record: CargoDetailsRecord, cargo: Cargo) -> None:
+        record.origin = cargo.origin.value
+        record.destination = cargo.destination.value
+        record.arrival_deadline = cargo.arrival_deadline
+        record.transport_status = cargo.transport_status
+        record.routing_status = cargo.routing_status
+        record.is_misdirected = cargo.is_misdirected
+        record.estimated_time_of_arrival = cargo.estimated_time_of_arrival
+        record.route_id = None if cargo.route is None else cargo.route.route_id
+        record.last_known_location = (
+            None
+            if cargo.last_known_location is None
+            else cargo.last_known_location.value
+        )
+        record.current_voyage_number = cargo.current_voyage_number
+        next_expected_activity = cargo.next_expected_activity
+        if next_expected_activity is None:
+            record.next_expected_handling_activity = None
+            record.next_expected_location = None
+            record.next_expected_voyage_number = None
+        else:
+            record.next_expected_handling_activity = next_expected_activity[0].value
+            record.next_expected_location = next_expected_activity[1].value
+            record.next_expected_voyage_number = (
+                next_expected_activity[2] if len(next_expected_activity) == 3 else None
+            )
+
+    def setup_table(self) -> None:
+        super().setup_table()
+        if self._datastore is not None:
+            self._datastore.setup_table(CargoDetailsRecord)
+
+    def drop_table(self) -> None:
+        super().drop_table()
+        if self._datastore is not None:
+            self._datastore.drop_table(CargoDetailsRecord)
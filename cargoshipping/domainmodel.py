@@ -1,6 +1,18 @@
 from datetime import datetime, timedelta
 from enum import Enum
-from typing import Any, Dict, List, Optional, Tuple, Type, TypeVar, Union
+from typing import (
+    Any,
+    Callable,
+    Dict,
+    FrozenSet,
+    List,
+    Optional,
+    Sequence,
+    Tuple,
+    Type,
+    TypeVar,
+    Union,
+)
 from uuid import UUID
 
 from eventsourcing.domain.model.aggregate import AggregateRoot
@@ -19,20 +31,65 @@ class Location(Enum):
     AUMEL = "AUMEL"
 
 
-# Leg of an Itinerary.
+# Leg of a route. Legs of itineraries recorded by earlier versions decode to
+# legs with location names, which encode to the same state as was recorded.
 class Leg(object):
-    def __init__(self, origin: str, destination: str, voyage_number: str):
-        self.origin: str = origin
-        self.destination: str = destination
+    __slots__ = ("origin", "destination", "voyage_number")
+
+    def __init__(self, origin: Location, destination: Location, voyage_number: str):
+        self.origin: Location = origin
+        self.destination: Location = destination
         self.voyage_number: str = voyage_number
 
-# Itinerary.
+
+# Itinerary, as recorded by value in RouteAssigned events by earlier versions.
+# Its attributes must stay the same, so that the recorded events decode to
+# objects that encode to the same state, otherwise their hashes won't match.
 class Itinerary(object):
     def __init__(self, origin: str, destination: str, legs: List[Leg]):
         self.origin = origin
         self.destination = destination
         self.legs = legs
 
+
+# Registered route, from an origin to a destination, along a sequence of legs.
+class Route(object):
+    __slots__ = (
+        "route_id",
+        "origin",
+        "destination",
+        "legs",
+        "_by_origin",
+        "_by_voyage",
+        "_destinations",
+    )
+
+    def __init__(
+        self, route_id: str, origin: str, destination: str, legs: Sequence[Leg]
+    ):
+        self.route_id: str = route_id
+        self.origin: str = origin
+        self.destination: str = destination
+        self.legs: Tuple[Leg, ...] = tuple(legs)
+        # Check the legs go from the origin to the destination, so that
+        # the next leg of a voyage always departs from where it arrives.
+        locations = [origin] + [leg.destination.value for leg in legs]
+        if [leg.origin.value for leg in legs] + [destination] != locations:
+            raise Exception(
+                "Legs of route {} don't connect {} to {}".format(
+                    route_id, origin, destination
+                )
+            )
+        # Indexes of the legs, used when handling events are registered.
+        self._by_origin: Dict[Location, Leg] = {leg.origin: leg for leg in legs}
+        self._by_voyage: Dict[str, int] = {
+            leg.voyage_number: i for i, leg in enumerate(legs)
+        }
+        self._destinations: FrozenSet[Location] = frozenset(
+            leg.destination for leg in legs
+        )
+
+
 # Handling activities.
 class HandlingActivity(Enum):
     RECEIVE = "RECEIVE"
@@ -51,28 +108,67 @@ T_cargo = TypeVar("T_cargo", bound="Cargo")
 
 
 # Some routes from one location to another.
-REGISTERED_ROUTES = {
-    ("HONGKONG", "STOCKHOLM"): [
-        Itinerary(
+REGISTERED_ROUTES: Dict[Tuple[Location, Location], Tuple[Route, ...]] = {
+    (Location.HONGKONG, Location.STOCKHOLM): (
+        Route(
+            route_id="HONGKONG->STOCKHOLM#0",
             origin="HONGKONG",
             destination="STOCKHOLM",
-            legs=[
-                Leg(origin="HONGKONG", destination="NEWYORK", voyage_number="V1"),
-                Leg(origin="NEWYORK", destination="STOCKHOLM", voyage_number="V2"),
-            ],
-        )
-    ],
-    ("TOKYO", "STOCKHOLM"): [
-        Itinerary(
+            legs=(
+                Leg(Location.HONGKONG, Location.NEWYORK, voyage_number="V1"),
+                Leg(Location.NEWYORK, Location.STOCKHOLM, voyage_number="V2"),
+            ),
+        ),
+    ),
+    (Location.TOKYO, Location.STOCKHOLM): (
+        Route(
+            route_id="TOKYO->STOCKHOLM#0",
             origin="TOKYO",
             destination="STOCKHOLM",
-            legs=[
-                Leg(origin="TOKYO", destination="HAMBURG", voyage_number="V3"),
-                Leg(origin="HAMBURG", destination="STOCKHOLM", voyage_number="V4"),
-            ],
-        )
-    ],
+            legs=(
+                Leg(Location.TOKYO, Location.HAMBURG, voyage_number="V3"),
+                Leg(Location.HAMBURG, Location.STOCKHOLM, voyage_number="V4"),
+            ),
+        ),
+    ),
 }
+
+
+# Indexes routes by origin location, and then by destination location.
+def index_routes_by_location(
+    routes: Dict[Tuple[Location, Location], Tuple[Route, ...]]
+) -> Dict[Location, Dict[Location, Tuple[Route, ...]]]:
+    index: Dict[Location, Dict[Location, Tuple[Route, ...]]] = {}
+    for (origin, destination), routes_between in routes.items():
+        index.setdefault(origin, {})[destination] = routes_between
+    return index
+
+
+REGISTERED_ROUTES_BY_LOCATION = index_routes_by_location(REGISTERED_ROUTES)
+
+# Registered routes, indexed by route ID (events refer to routes by ID).
+ROUTES_BY_ID: Dict[str, Route] = {
+    route.route_id: route
+    for routes in REGISTERED_ROUTES.values()
+    for route in routes
+}
+
+
+# Finds the registered route that has the origin, destination and voyages
+# of an itinerary recorded by value (before routes were recorded by ID).
+def find_registered_route(itinerary: Itinerary) -> Route:
+    origin = Location[itinerary.origin]
+    destination = Location[itinerary.destination]
+    voyage_numbers = [leg.voyage_number for leg in itinerary.legs]
+    for registered in REGISTERED_ROUTES.get((origin, destination), ()):
+        if [leg.voyage_number for leg in registered.legs] == voyage_numbers:
+            return registered
+    raise Exception(
+        "Can't find registered route from {} to {} with voyages {}".format(
+            itinerary.origin, itinerary.destination, ", ".join(voyage_numbers)
+        )
+    )
+
 NextExpectedActivity = Optional[
     Union[Tuple[HandlingActivity, Location], Tuple[HandlingActivity, Location, str]]
 ]
@@ -85,7 +181,9 @@ class Aggregate(AggregateRoot):
 
 # The Cargo aggregate is an event sourced domain model aggregate that
 # specifies the routing from origin to destination, and can track what
-# happens to the cargo after it has been booked.
+# happens to the cargo after it has been booked. Its state is kept in
+# the instance __dict__, not in __slots__, because snapshots of the
+# aggregate are taken from, and restored into, the instance __dict__.
 class Cargo(Aggregate):
     @classmethod
     def new_booking(
@@ -115,10 +213,44 @@ class Cargo(Aggregate):
         self._is_misdirected: bool = False
         self._estimated_time_of_arrival: Optional[datetime] = None
         self._next_expected_activity: NextExpectedActivity = None
-        self._route: Optional[Itinerary] = None
+        # The route is held by ID, so that snapshots don't have a copy of it.
+        self._route_id: Optional[str] = None
         self._last_known_location: Optional[Location] = None
         self._current_voyage_number: Optional[str] = None
 
+    @classmethod
+    def restore(
+        cls: Type[T_cargo],
+        id: UUID,
+        origin: Location,
+        destination: Location,
+        arrival_deadline: datetime,
+        transport_status: str,
+        routing_status: str,
+        is_misdirected: bool,
+        estimated_time_of_arrival: Optional[datetime],
+        next_expected_activity: NextExpectedActivity,
+        route_id: Optional[str],
+        last_known_location: Optional[Location],
+        current_voyage_number: Optional[str],
+    ) -> T_cargo:
+        # Restores a cargo from its current state, without its events, so
+        # that further events can be applied to it by the event mutators.
+        cargo: T_cargo = object.__new__(cls)
+        cargo._id = id
+        cargo._origin = origin
+        cargo._destination = destination
+        cargo._arrival_deadline = arrival_deadline
+        cargo._transport_status = transport_status
+        cargo._routing_status = routing_status
+        cargo._is_misdirected = is_misdirected
+        cargo._estimated_time_of_arrival = estimated_time_of_arrival
+        cargo._next_expected_activity = next_expected_activity
+        cargo._route_id = route_id
+        cargo._last_known_location = last_known_location
+        cargo._current_voyage_number = current_voyage_number
+        return cargo
+
     @property
     def origin(self) -> Location:
         return self._origin
@@ -152,8 +284,8 @@ class Cargo(Aggregate):
         return self._next_expected_activity
 
     @property
-    def route(self) -> Optional[Itinerary]:
-        return self._route
+    def route(self) -> Optional[Route]:
+        return None if self._route_id is None else ROUTES_BY_ID[self._route_id]
 
     @property
     def last_known_location(self) -> Optional[Location]:
@@ -163,6 +295,8 @@ class Cargo(Aggregate):
     def current_voyage_number(self) -> Optional[str]:
         return self._current_voyage_number
 
+    # Event attributes are declared with annotations, rather than properties,
+    # so that reading them is a plain instance attribute lookup.
     class Event(Aggregate.Event):
         pass
 
@@ -170,28 +304,41 @@ class Cargo(Aggregate):
         self.__trigger_event__(self.DestinationChanged, destination=destination)
 
     class DestinationChanged(Event):
+        destination: Location
+
         def mutate(self, obj: "Cargo") -> None:
             obj._destination = self.destination
 
-        @property
-        def destination(self) -> Location:
-            return self.__dict__["destination"]
-
-    def assign_route(self, itinerary: Itinerary) -> None:
-        self.__trigger_event__(self.RouteAssigned, route=itinerary)
+    def assign_route(self, route: Route) -> None:
+        self.__trigger_event__(
+            self.RouteAssigned,
+            route_id=route.route_id,
+            estimated_time_of_arrival=datetime.now() + timedelta(weeks=1),
+        )
 
     class RouteAssigned(Event):
+        route_id: str
+        estimated_time_of_arrival: datetime
+
         def mutate(self, obj: "Cargo") -> None:
-            obj._route = self.route
+            if "route_id" in self.__dict__:
+                obj._route_id = self.route_id
+            else:
+                # Events recorded by earlier versions have the whole itinerary.
+                route = find_registered_route(self.__dict__["route"])
+                obj._route_id = route.route_id
             obj._routing_status = "ROUTED"
-            obj._estimated_time_of_arrival = datetime.now() + timedelta(weeks=1)
+            if "estimated_time_of_arrival" in self.__dict__:
+                obj._estimated_time_of_arrival = self.estimated_time_of_arrival
+            else:
+                # Events recorded by earlier versions don't have an estimated
+                # time of arrival, so estimate it from when the event happened.
+                obj._estimated_time_of_arrival = datetime.fromtimestamp(
+                    float(self.timestamp)
+                ) + timedelta(weeks=1)
             obj._next_expected_activity = (HandlingActivity.RECEIVE, obj.origin)
             obj._is_misdirected = False
 
-        @property
-        def route(self) -> Itinerary:
-            return self.__dict__["route"]
-
     def register_handling_event(
         self,
         tracking_id: UUID,
@@ -208,75 +355,85 @@ class Cargo(Aggregate):
         )
 
     class HandlingEventRegistered(Event):
+        tracking_id: UUID
+        voyage_number: Optional[str]
+        location: Location
+        handling_activity: HandlingActivity
+
         def mutate(self, obj: "Cargo") -> None:
             assert obj.route is not None
-            if self.handling_activity == HandlingActivity.RECEIVE:
-                obj._transport_status = "IN_PORT"
-                obj._last_known_location = self.location
+            try:
+                mutator = self._mutators[self.handling_activity]
+            except KeyError:
+                raise Exception(
+                    "Unsupported handling event: {}".format(self.handling_activity)
+                )
+            mutator(self, obj, obj.route)
+
+        def _on_receive(self, obj: "Cargo", route: Route) -> None:
+            obj._transport_status = "IN_PORT"
+            obj._last_known_location = self.location
+            obj._next_expected_activity = (
+                HandlingActivity.LOAD,
+                self.location,
+                route.legs[0].voyage_number,
+            )
+
+        def _on_load(self, obj: "Cargo", route: Route) -> None:
+            obj._transport_status = "ONBOARD_CARRIER"
+            obj._current_voyage_number = self.voyage_number
+            leg = route._by_origin.get(self.location)
+            if leg is None or leg.voyage_number != self.voyage_number:
+                raise Exception(
+                    "Can't find leg with origin={} and "
+                    "voyage_number={}".format(self.location, self.voyage_number)
+                )
+            obj._next_expected_activity = (
+                HandlingActivity.UNLOAD,
+                leg.destination,
+                self.voyage_number,
+            )
+
+        def _on_unload(self, obj: "Cargo", route: Route) -> None:
+            obj._current_voyage_number = None
+            obj._last_known_location = self.location
+            obj._transport_status = "IN_PORT"
+            if self.location == obj.destination:
                 obj._next_expected_activity = (
-                    HandlingActivity.LOAD,
+                    HandlingActivity.CLAIM,
                     self.location,
-                    obj.route.legs[0].voyage_number,
                 )
-            elif self.handling_activity == HandlingActivity.LOAD:
-                obj._transport_status = "ONBOARD_CARRIER"
-                obj._current_voyage_number = self.voyage_number
-                for leg in obj.route.legs:
-                    if leg.origin == self.location.value:
-                        if leg.voyage_number == self.voyage_number:
-                            obj._next_expected_activity = (
-                                HandlingActivity.UNLOAD,
-                                Location[leg.destination],
-                                self.voyage_number,
-                            )
-                            break
-                else:
-                    raise Exception(
-                        "Can't find leg with origin={} and "
-                        "voyage_number={}".format(self.location, self.voyage_number)
-                    )
-
-            elif self.handling_activity == HandlingActivity.UNLOAD:
-                obj._current_voyage_number = None
-                obj._last_known_location = self.location
-                obj._transport_status = "IN_PORT"
-                if self.location == obj.destination:
+            elif self.location in route._destinations:
+                i = route._by_voyage.get(self.voyage_number)
+                if i is None:
+                    pass
+                elif route.legs[i].destination is self.location:
+                    next_leg: Leg = route.legs[i + 1]
                     obj._next_expected_activity = (
-                        HandlingActivity.CLAIM,
+                        HandlingActivity.LOAD,
                         self.location,
+                        next_leg.voyage_number,
                     )
-                elif self.location.value in [leg.destination for leg in obj.route.legs]:
-                    for i, leg in enumerate(obj.route.legs):
-                        if leg.voyage_number == self.voyage_number:
-                            next_leg: Leg = obj.route.legs[i + 1]
-                            assert Location[next_leg.origin] == self.location
-                            obj._next_expected_activity = (
-                                HandlingActivity.LOAD,
-                                self.location,
-                                next_leg.voyage_number,
-                            )
-                            break
                 else:
+                    # Unloaded from the voyage somewhere other than where
+                    # the voyage's leg of the route ends.
                     obj._is_misdirected = True
                     obj._next_expected_activity = None
-
-            elif self.handling_activity == HandlingActivity.CLAIM:
-                obj._next_expected_activity = None
-                obj._transport_status = "CLAIMED"
-
             else:
-                raise Exception(
-                    "Unsupported handling event: {}".format(self.handling_activity)
-                )
-
-        @property
-        def voyage_number(self) -> str:
-            return self.__dict__["voyage_number"]
-
-        @property
-        def location(self) -> Location:
-            return self.__dict__["location"]
+                obj._is_misdirected = True
+                obj._next_expected_activity = None
 
-        @property
-        def handling_activity(self) -> str:
-            return self.__dict__["handling_activity"]
+        def _on_claim(self, obj: "Cargo", route: Route) -> None:
+            obj._next_expected_activity = None
+            obj._transport_status = "CLAIMED"
+
+        # Mutator functions, indexed by handling activity.
+        _mutators: Dict[
+            HandlingActivity,
+            Callable[["Cargo.HandlingEventRegistered", "Cargo", Route], None],
+        ] = {
+            HandlingActivity.RECEIVE: _on_receive,
+            HandlingActivity.LOAD: _on_load,
+            HandlingActivity.UNLOAD: _on_unload,
+            HandlingActivity.CLAIM: _on_claim,
+        }
@@ -1,17 +1,17 @@
 from datetime import datetime
-from typing import Any, List, Optional, Tuple, Union
+from typing import List, Optional
 from uuid import UUID
 
 from eventsourcing.system.runner import InProcessRunner
 
-from cargoshipping.application import BookingApplication
+from cargoshipping.application import BookingApplication, CargoProjection
 from cargoshipping.domainmodel import (
     CargoDetails,
     HandlingActivity,
-    Itinerary,
     ItineraryDetails,
     LegDetails,
     Location,
+    Route,
 )
 
 
@@ -21,6 +21,7 @@ class LocalClient(object):
     def __init__(self, runner: InProcessRunner):
         self.runner: InProcessRunner = runner
         self.booking_application = self.runner.get(BookingApplication)
+        self.cargo_projection = self.runner.get(CargoProjection)
 
     def book_new_cargo(
         self, origin: str, destination: str, arrival_deadline: datetime
@@ -31,50 +32,7 @@ class LocalClient(object):
         return str(tracking_id)
 
     def get_cargo_details(self, tracking_id: str) -> CargoDetails:
-        cargo = self.booking_application.get_cargo(UUID(tracking_id))
-
-        # Present 'next_expected_activity'.
-        next_expected_activity: Optional[Union[Tuple[Any, Any], Tuple[Any, Any, Any]]]
-        if cargo.next_expected_activity is None:
-            next_expected_activity = None
-        elif len(cargo.next_expected_activity) == 2:
-            next_expected_activity = (
-                cargo.next_expected_activity[0].value,
-                cargo.next_expected_activity[1].value,
-            )
-        elif len(cargo.next_expected_activity) == 3:
-            next_expected_activity = (
-                cargo.next_expected_activity[0].value,
-                cargo.next_expected_activity[1].value,
-                cargo.next_expected_activity[2],
-            )
-        else:
-            raise Exception(
-                "Invalid next expected activity: {}".format(
-                    cargo.next_expected_activity
-                )
-            )
-
-        # Present 'last_known_location'.
-        if cargo.last_known_location is None:
-            last_known_location = None
-        else:
-            last_known_location = cargo.last_known_location.value
-
-        # Present the cargo details.
-        return {
-            "id": str(cargo.id),
-            "origin": cargo.origin.value,
-            "destination": cargo.destination.value,
-            "arrival_deadline": cargo.arrival_deadline,
-            "transport_status": cargo.transport_status,
-            "routing_status": cargo.routing_status,
-            "is_misdirected": cargo.is_misdirected,
-            "estimated_time_of_arrival": cargo.estimated_time_of_arrival,
-            "next_expected_activity": next_expected_activity,
-            "last_known_location": last_known_location,
-            "current_voyage_number": cargo.current_voyage_number,
-        }
+        return self.cargo_projection.get_cargo_details(UUID(tracking_id))
 
     def change_destination(self, tracking_id: str, destination: str) -> None:
         self.booking_application.change_destination(
@@ -87,18 +45,18 @@ class LocalClient(object):
         )
         return [self.dict_from_itinerary(route) for route in routes]
 
-    def dict_from_itinerary(self, itinerary: Itinerary) -> ItineraryDetails:
+    def dict_from_itinerary(self, route: Route) -> ItineraryDetails:
         legs_details = []
-        for leg in itinerary.legs:
+        for leg in route.legs:
             leg_details: LegDetails = {
-                "origin": leg.origin,
-                "destination": leg.destination,
+                "origin": leg.origin.value,
+                "destination": leg.destination.value,
                 "voyage_number": leg.voyage_number,
             }
             legs_details.append(leg_details)
         route_details: ItineraryDetails = {
-            "origin": itinerary.origin,
-            "destination": itinerary.destination,
+            "origin": route.origin,
+            "destination": route.destination,
             "legs": legs_details,
         }
         return route_details
@@ -0,0 +1,27 @@
+from eventsourcing.infrastructure.sqlalchemy.records import Base
+from sqlalchemy import Boolean, Column, DateTime, String
+from sqlalchemy_utils.types.uuid import UUIDType
+
+
+# The current state of each cargo, as projected from the cargo events.
+class CargoDetailsRecord(Base):
+    __tablename__ = "cargo_details"
+
+    # Tracking ID of the cargo.
+    id = Column(UUIDType(), primary_key=True)
+
+    origin = Column(String(255), nullable=False)
+    destination = Column(String(255), nullable=False)
+    arrival_deadline = Column(DateTime(), nullable=False)
+    transport_status = Column(String(255), nullable=False)
+    routing_status = Column(String(255), nullable=False)
+    is_misdirected = Column(Boolean(), nullable=False)
+    estimated_time_of_arrival = Column(DateTime())
+    route_id = Column(String(255))
+    last_known_location = Column(String(255))
+    current_voyage_number = Column(String(255))
+
+    # Next expected activity (voyage number is null for RECEIVE and CLAIM).
+    next_expected_handling_activity = Column(String(255))
+    next_expected_location = Column(String(255))
+    next_expected_voyage_number = Column(String(255))
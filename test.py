@@ -1,18 +1,27 @@
 from datetime import datetime, timedelta
+from decimal import Decimal
 from unittest import TestCase
+from uuid import UUID, uuid4
 
 from eventsourcing.application.sqlalchemy import SQLAlchemyApplication
+from eventsourcing.infrastructure.sequenceditem import StoredEvent
 from eventsourcing.system.definition import System
 from eventsourcing.system.runner import SingleThreadedRunner
 
-from cargoshipping.application import BookingApplication
+from cargoshipping.application import BookingApplication, CargoProjection
+from cargoshipping.domainmodel import (
+    Cargo,
+    HandlingActivity,
+    Location,
+    ROUTES_BY_ID,
+)
 from cargoshipping.interface import LocalClient, select_preferred_itinerary
 
 
 class TestCargoShippingExample(TestCase):
     def setUp(self) -> None:
         self.runner = SingleThreadedRunner(
-            system=System(BookingApplication),
+            system=System(BookingApplication | CargoProjection),
             infrastructure_class=SQLAlchemyApplication,
             setup_tables=True,
         )
@@ -39,6 +48,403 @@ class TestCargoShippingExample(TestCase):
         self.assertEqual(cargo_details["destination"], "AUMEL")
         self.assertEqual(cargo_details["arrival_deadline"], arrival_deadline)
 
+    def test_cached_cargo_is_evicted_when_command_fails(self) -> None:
+        arrival_deadline = datetime.now() + timedelta(weeks=3)
+        tracking_id = self.client.book_new_cargo(
+            "HONGKONG", "STOCKHOLM", arrival_deadline
+        )
+        routes_details = self.client.request_possible_routes_for_cargo(tracking_id)
+        route_details = select_preferred_itinerary(routes_details)
+        self.client.assign_route(tracking_id, route_details)
+        self.client.register_handling_event(tracking_id, None, "HONGKONG", "RECEIVE")
+
+        # The cargo is cached after it has been got.
+        booking_application = self.client.booking_application
+        cargo = booking_application.get_cargo(UUID(tracking_id))
+        self.assertIs(booking_application.get_cargo(UUID(tracking_id)), cargo)
+
+        # The cached cargo is still got after it has been changed and saved.
+        self.client.change_destination(tracking_id, destination="STOCKHOLM")
+        self.assertIs(booking_application.get_cargo(UUID(tracking_id)), cargo)
+
+        # Loading onto a voyage that isn't on the route fails.
+        with self.assertRaises(Exception):
+            self.client.register_handling_event(tracking_id, "V3", "HONGKONG", "LOAD")
+
+        # The partly mutated cargo was evicted, and the recorded state is intact.
+        reloaded_cargo = booking_application.get_cargo(UUID(tracking_id))
+        self.assertIsNot(reloaded_cargo, cargo)
+        self.assertEqual(reloaded_cargo.transport_status, "IN_PORT")
+        self.assertEqual(reloaded_cargo.current_voyage_number, None)
+        self.assertEqual(
+            reloaded_cargo.next_expected_activity,
+            (HandlingActivity.LOAD, Location.HONGKONG, "V1"),
+        )
+        cargo_details = self.client.get_cargo_details(tracking_id)
+        self.assertEqual(cargo_details["transport_status"], "IN_PORT")
+        self.assertEqual(cargo_details["current_voyage_number"], None)
+        self.assertEqual(
+            cargo_details["next_expected_activity"], ("LOAD", "HONGKONG", "V1")
+        )
+
+    def test_route_assigned_events_recorded_with_whole_itinerary_are_replayed(
+        self,
+    ) -> None:
+        # Events recorded by an earlier version, which recorded the
+        # whole itinerary by value, and didn't record an ETA.
+        tracking_id = UUID("700357d8-2abb-4452-b45a-18a31093498f")
+        recorded_events = [
+            StoredEvent(
+                originator_id=tracking_id,
+                originator_version=0,
+                topic="cargoshipping.domainmodel#Cargo.Created",
+                state=(
+                    b'{"originator_id":{"UUID":"700357d82abb4452b45a18a31093498f"},'
+                    b'"originator_version":0,'
+                    b'"originator_topic":"cargoshipping.domainmodel#Cargo",'
+                    b'"origin":{"__enum__":{'
+                    b'"topic":"cargoshipping.domainmodel#Location","name":"TOKYO"}},'
+                    b'"destination":{"__enum__":{'
+                    b'"topic":"cargoshipping.domainmodel#Location",'
+                    b'"name":"STOCKHOLM"}},'
+                    b'"arrival_deadline":{'
+                    b'"ISO8601_datetime":"2020-06-01T12:00:00.000000"},'
+                    b'"__previous_hash__":"",'
+                    b'"timestamp":{"__decimal__":"1792101746.521352"},'
+                    b'"__event_topic__":"cargoshipping.domainmodel#Cargo.Created",'
+                    b'"__event_hash_method_name__":"__hash_object_v2__",'
+                    b'"__event_hash__":"7f2176d4716081ce0319f083f79521fb'
+                    b'323e2b09ab8c307a24a8fd2c70647fa1"}'
+                ),
+            ),
+            StoredEvent(
+                originator_id=tracking_id,
+                originator_version=1,
+                topic="cargoshipping.domainmodel#Cargo.RouteAssigned",
+                state=(
+                    b'{"originator_id":{"UUID":"700357d82abb4452b45a18a31093498f"},'
+                    b'"originator_version":1,'
+                    b'"route":{"__class__":{"state":{'
+                    b'"origin":"TOKYO","destination":"STOCKHOLM","legs":['
+                    b'{"__class__":{"state":{'
+                    b'"origin":"TOKYO","destination":"HAMBURG","voyage_number":"V3"},'
+                    b'"topic":"cargoshipping.domainmodel#Leg"}},'
+                    b'{"__class__":{"state":{'
+                    b'"origin":"HAMBURG","destination":"STOCKHOLM",'
+                    b'"voyage_number":"V4"},'
+                    b'"topic":"cargoshipping.domainmodel#Leg"}}]},'
+                    b'"topic":"cargoshipping.domainmodel#Itinerary"}},'
+                    b'"__previous_hash__":"7f2176d4716081ce0319f083f79521fb'
+                    b'323e2b09ab8c307a24a8fd2c70647fa1",'
+                    b'"timestamp":{"__decimal__":"1792101746.527411"},'
+                    b'"__event_topic__":'
+                    b'"cargoshipping.domainmodel#Cargo.RouteAssigned",'
+                    b'"__event_hash_method_name__":"__hash_object_v2__",'
+                    b'"__event_hash__":"7232b3cea78043b95bf42c5acee90954'
+                    b'0c6477206f0b268fdd4f46e9845758c9"}'
+                ),
+            ),
+        ]
+        booking_application = self.client.booking_application
+        booking_application.event_store.record_manager.record_items(recorded_events)
+
+        # The recorded events are replayed, and the registered route is assigned.
+        cargo = booking_application.get_cargo(tracking_id)
+        self.assertIs(cargo.route, ROUTES_BY_ID["TOKYO->STOCKHOLM#0"])
+        self.assertEqual(cargo.routing_status, "ROUTED")
+        self.assertEqual(
+            cargo.estimated_time_of_arrival,
+            datetime.fromtimestamp(1792101746.527411) + timedelta(weeks=1),
+        )
+        self.assertEqual(
+            cargo.next_expected_activity, (HandlingActivity.RECEIVE, Location.TOKYO)
+        )
+
+    def test_estimated_time_of_arrival_is_the_same_when_events_replayed(self) -> None:
+        arrival_deadline = datetime.now() + timedelta(weeks=3)
+        tracking_id = self.client.book_new_cargo("TOKYO", "STOCKHOLM", arrival_deadline)
+        routes_details = self.client.request_possible_routes_for_cargo(tracking_id)
+        route_details = select_preferred_itinerary(routes_details)
+        self.client.assign_route(tracking_id, route_details)
+
+        # The projection and a freshly replayed cargo have the recorded ETA.
+        cargo_details = self.client.get_cargo_details(tracking_id)
+        booking_application = self.client.booking_application
+        cargo = booking_application.repository[UUID(tracking_id)]
+        self.assertTrue(cargo.estimated_time_of_arrival)
+        self.assertEqual(
+            cargo.estimated_time_of_arrival,
+            cargo_details["estimated_time_of_arrival"],
+        )
+
+    def test_route_assigned_events_recorded_without_eta_are_replayed(self) -> None:
+        arrival_deadline = datetime.now() + timedelta(weeks=3)
+        cargo = Cargo.new_booking(Location.TOKYO, Location.STOCKHOLM, arrival_deadline)
+
+        # Earlier versions didn't record the estimated time of arrival.
+        assigned_on = datetime(2020, 1, 1, 12, 0)
+        event = object.__new__(Cargo.RouteAssigned)
+        event.__dict__.update(
+            originator_id=cargo.id,
+            route_id="TOKYO->STOCKHOLM#0",
+            timestamp=Decimal(assigned_on.timestamp()),
+        )
+
+        # The estimate is one week after the event happened, on every replay.
+        event.mutate(cargo)
+        self.assertEqual(
+            cargo.estimated_time_of_arrival, assigned_on + timedelta(weeks=1)
+        )
+
+    def test_cargo_unloaded_where_voyage_leg_does_not_end_is_misdirected(
+        self,
+    ) -> None:
+        arrival_deadline = datetime.now() + timedelta(weeks=3)
+        tracking_id = self.client.book_new_cargo(
+            "HONGKONG", "STOCKHOLM", arrival_deadline
+        )
+        routes_details = self.client.request_possible_routes_for_cargo(tracking_id)
+        route_details = select_preferred_itinerary(routes_details)
+        self.client.assign_route(tracking_id, route_details)
+        self.client.register_handling_event(tracking_id, None, "HONGKONG", "RECEIVE")
+        self.client.register_handling_event(tracking_id, "V1", "HONGKONG", "LOAD")
+
+        # NEWYORK is on the route, but the leg of voyage V2 ends in STOCKHOLM.
+        self.client.register_handling_event(tracking_id, "V2", "NEWYORK", "UNLOAD")
+        cargo_details = self.client.get_cargo_details(tracking_id)
+        self.assertEqual(cargo_details["is_misdirected"], True)
+        self.assertEqual(cargo_details["next_expected_activity"], None)
+        self.assertEqual(cargo_details["last_known_location"], "NEWYORK")
+
+    def test_handling_events_can_be_registered_in_bulk(self) -> None:
+        arrival_deadline = datetime.now() + timedelta(weeks=3)
+        tracking_id = self.client.book_new_cargo("TOKYO", "STOCKHOLM", arrival_deadline)
+        routes_details = self.client.request_possible_routes_for_cargo(tracking_id)
+        route_details = select_preferred_itinerary(routes_details)
+        self.client.assign_route(tracking_id, route_details)
+
+        # Register the handling events of the first leg with one save.
+        booking_application = self.client.booking_application
+        booking_application.register_handling_events_bulk(
+            UUID(tracking_id),
+            [
+                (None, Location.TOKYO, HandlingActivity.RECEIVE),
+                ("V3", Location.TOKYO, HandlingActivity.LOAD),
+                ("V3", Location.HAMBURG, HandlingActivity.UNLOAD),
+            ],
+        )
+        cargo_details = self.client.get_cargo_details(tracking_id)
+        self.assertEqual(cargo_details["last_known_location"], "HAMBURG")
+        self.assertEqual(cargo_details["transport_status"], "IN_PORT")
+        self.assertEqual(
+            cargo_details["next_expected_activity"], ("LOAD", "HAMBURG", "V4")
+        )
+
+    def test_commands_can_be_batched(self) -> None:
+        arrival_deadline = datetime.now() + timedelta(weeks=3)
+        cargo_id1 = self.client.book_new_cargo("NLRTM", "USDAL", arrival_deadline)
+        cargo_id2 = self.client.book_new_cargo("NLRTM", "USDAL", arrival_deadline)
+
+        # Changes made in a batch are saved when the batch ends.
+        with self.client.booking_application.batch():
+            self.client.change_destination(cargo_id1, destination="AUMEL")
+            self.client.change_destination(cargo_id2, destination="AUMEL")
+            cargo_details = self.client.get_cargo_details(cargo_id1)
+            self.assertEqual(cargo_details["destination"], "USDAL")
+
+            # A cargo booked in the batch can be changed before it is saved.
+            cargo_id3 = self.client.book_new_cargo("NLRTM", "USDAL", arrival_deadline)
+            self.client.change_destination(cargo_id3, destination="AUMEL")
+
+        cargo_details = self.client.get_cargo_details(cargo_id1)
+        self.assertEqual(cargo_details["destination"], "AUMEL")
+        cargo_details = self.client.get_cargo_details(cargo_id2)
+        self.assertEqual(cargo_details["destination"], "AUMEL")
+        cargo_details = self.client.get_cargo_details(cargo_id3)
+        self.assertEqual(cargo_details["destination"], "AUMEL")
+
+    def test_batch_is_not_saved_when_a_command_fails(self) -> None:
+        arrival_deadline = datetime.now() + timedelta(weeks=3)
+        cargo_id1 = self.client.book_new_cargo("NLRTM", "USDAL", arrival_deadline)
+        cargo_id2 = self.client.book_new_cargo(
+            "HONGKONG", "STOCKHOLM", arrival_deadline
+        )
+        routes_details = self.client.request_possible_routes_for_cargo(cargo_id2)
+        route_details = select_preferred_itinerary(routes_details)
+        self.client.assign_route(cargo_id2, route_details)
+        self.client.register_handling_event(cargo_id2, None, "HONGKONG", "RECEIVE")
+
+        # A command fails in the batch, and the failure is caught.
+        booking_application = self.client.booking_application
+        with self.assertRaises(Exception):
+            with booking_application.batch():
+                self.client.change_destination(cargo_id1, destination="AUMEL")
+                self.client.register_handling_event(cargo_id2, "V1", "HONGKONG", "LOAD")
+                try:
+                    self.client.register_handling_event(
+                        cargo_id2, "V9", "NEWYORK", "LOAD"
+                    )
+                except Exception:
+                    pass
+
+        # None of the changes in the batch were saved or left in the cache.
+        for cargo_id in [cargo_id1, cargo_id2]:
+            cargo = booking_application.get_cargo(UUID(cargo_id))
+            recorded = booking_application.repository[UUID(cargo_id)]
+            self.assertEqual(cargo.__version__, recorded.__version__)
+            self.assertEqual(cargo.destination, recorded.destination)
+            self.assertEqual(
+                cargo.current_voyage_number, recorded.current_voyage_number
+            )
+        self.assertEqual(recorded.current_voyage_number, None)
+        cargo_details = self.client.get_cargo_details(cargo_id1)
+        self.assertEqual(cargo_details["destination"], "USDAL")
+
+    def test_batch_is_saved_when_a_command_fails_on_an_unchanged_cargo(
+        self,
+    ) -> None:
+        arrival_deadline = datetime.now() + timedelta(weeks=3)
+        cargo_id1 = self.client.book_new_cargo("NLRTM", "USDAL", arrival_deadline)
+        cargo_id2 = self.client.book_new_cargo(
+            "HONGKONG", "STOCKHOLM", arrival_deadline
+        )
+        routes_details = self.client.request_possible_routes_for_cargo(cargo_id2)
+        route_details = select_preferred_itinerary(routes_details)
+        self.client.assign_route(cargo_id2, route_details)
+        self.client.register_handling_event(cargo_id2, None, "HONGKONG", "RECEIVE")
+
+        # Commands fail in the batch on cargos that it hasn't changed.
+        booking_application = self.client.booking_application
+        with booking_application.batch():
+            self.client.change_destination(cargo_id1, destination="AUMEL")
+            with self.assertRaises(Exception):
+                self.client.register_handling_event(
+                    cargo_id2, "V9", "NEWYORK", "LOAD"
+                )
+            with self.assertRaises(Exception):
+                self.client.change_destination(str(uuid4()), destination="AUMEL")
+
+        # The changes in the batch were saved.
+        cargo_details = self.client.get_cargo_details(cargo_id1)
+        self.assertEqual(cargo_details["destination"], "AUMEL")
+        cargo = booking_application.get_cargo(UUID(cargo_id2))
+        recorded = booking_application.repository[UUID(cargo_id2)]
+        self.assertEqual(cargo.__version__, recorded.__version__)
+        self.assertEqual(cargo.current_voyage_number, None)
+
+    def test_failed_cargo_is_not_got_again_in_a_batch(self) -> None:
+        arrival_deadline = datetime.now() + timedelta(weeks=3)
+        tracking_id = self.client.book_new_cargo(
+            "HONGKONG", "STOCKHOLM", arrival_deadline
+        )
+        routes_details = self.client.request_possible_routes_for_cargo(tracking_id)
+        route_details = select_preferred_itinerary(routes_details)
+        self.client.assign_route(tracking_id, route_details)
+        self.client.register_handling_event(tracking_id, None, "HONGKONG", "RECEIVE")
+
+        booking_application = self.client.booking_application
+        with self.assertRaises(Exception):
+            with booking_application.batch():
+                self.client.register_handling_event(
+                    tracking_id, "V1", "HONGKONG", "LOAD"
+                )
+                failed_cargo = booking_application.get_cargo(UUID(tracking_id))
+                try:
+                    self.client.register_handling_event(
+                        tracking_id, "V9", "NEWYORK", "LOAD"
+                    )
+                except Exception:
+                    pass
+                cargo = booking_application.get_cargo(UUID(tracking_id))
+                recorded = booking_application.repository[UUID(tracking_id)]
+
+        # The partly mutated cargo wasn't got again during the batch.
+        self.assertIsNot(cargo, failed_cargo)
+        self.assertEqual(cargo.__version__, recorded.__version__)
+        self.assertEqual(cargo.current_voyage_number, recorded.current_voyage_number)
+        self.assertEqual(cargo.next_expected_activity, recorded.next_expected_activity)
+
+        # After the batch, the cached cargo still agrees with the recorded events.
+        cargo = booking_application.get_cargo(UUID(tracking_id))
+        recorded = booking_application.repository[UUID(tracking_id)]
+        self.assertEqual(cargo.current_voyage_number, None)
+        self.assertEqual(recorded.current_voyage_number, None)
+        self.assertEqual(cargo.next_expected_activity, recorded.next_expected_activity)
+
+    def test_commands_can_be_executed_by_name(self) -> None:
+        arrival_deadline = datetime.now() + timedelta(weeks=3)
+        booking_application = self.client.booking_application
+        (tracking_id,) = booking_application.execute_commands(
+            [
+                (
+                    "book_new_cargo",
+                    {
+                        "origin": Location.NLRTM,
+                        "destination": Location.USDAL,
+                        "arrival_deadline": arrival_deadline,
+                    },
+                )
+            ]
+        )
+        booking_application.execute_commands(
+            [
+                (
+                    "change_destination",
+                    {"tracking_id": tracking_id, "destination": Location.AUMEL},
+                )
+            ]
+        )
+        cargo_details = self.client.get_cargo_details(str(tracking_id))
+        self.assertEqual(cargo_details["destination"], "AUMEL")
+
+        with self.assertRaises(Exception):
+            booking_application.execute_commands([("discard_cargo", {})])
+
+    def test_cargo_snapshots_are_taken_periodically(self) -> None:
+        arrival_deadline = datetime.now() + timedelta(weeks=3)
+        cargo_id = self.client.book_new_cargo("HONGKONG", "STOCKHOLM", arrival_deadline)
+        routes_details = self.client.request_possible_routes_for_cargo(cargo_id)
+        route_details = select_preferred_itinerary(routes_details)
+        self.client.assign_route(cargo_id, route_details)
+        self.client.register_handling_event(cargo_id, None, "HONGKONG", "RECEIVE")
+        self.client.register_handling_event(cargo_id, "V1", "HONGKONG", "LOAD")
+
+        # Change the destination enough times to pass the snapshot period.
+        destinations = ["TOKYO", "STOCKHOLM"] * 4
+        for destination in destinations:
+            self.client.change_destination(cargo_id, destination=destination)
+
+        # A snapshot was taken after the tenth event.
+        booking_application = self.client.booking_application
+        snapshot = booking_application.snapshot_strategy.get_snapshot(UUID(cargo_id))
+        self.assertEqual(snapshot.originator_version, 9)
+
+        # The cargo is reconstructed from the snapshot and subsequent events.
+        cargo = booking_application.repository[UUID(cargo_id)]
+        self.assertEqual(cargo.__version__, 11)
+        self.assertEqual(cargo.destination, Location.STOCKHOLM)
+        self.assertEqual(cargo.arrival_deadline, arrival_deadline)
+        self.assertEqual(cargo.transport_status, "ONBOARD_CARRIER")
+        self.assertEqual(cargo.current_voyage_number, "V1")
+        self.assertEqual(
+            cargo.next_expected_activity,
+            (HandlingActivity.UNLOAD, Location.NEWYORK, "V1"),
+        )
+
+        # The route is the registered route, not a copy from the snapshot.
+        self.assertIs(cargo.route, ROUTES_BY_ID["HONGKONG->STOCKHOLM#0"])
+        self.assertNotIn("_route", snapshot.state)
+        self.assertEqual(snapshot.state["_route_id"], "HONGKONG->STOCKHOLM#0")
+
+        # The restored cargo can be handled further.
+        cargo.register_handling_event(
+            cargo.id, "V1", Location.NEWYORK, HandlingActivity.UNLOAD
+        )
+        self.assertEqual(
+            cargo.next_expected_activity,
+            (HandlingActivity.LOAD, Location.NEWYORK, "V2"),
+        )
+
     def test_scenario_cargo_from_hongkong_to_stockholm(self) -> None:
         # Test setup: A cargo should be shipped from Hongkong to Stockholm,
         # and it should arrive in no more than two weeks.